@@ -0,0 +1,175 @@
+"""
+Single entry point for every pipeline stage, e.g.
+
+    python data_processing/cli.py stage2 --files 0 12
+    python data_processing/cli.py --data-root /mnt/karaoke/data tokens --files "1*"
+    python data_processing/cli.py export --format jsonl.gz
+    python data_processing/cli.py align --fps 60
+
+Heavy modules (pandas, the stage scripts) are only imported by the subcommand that needs them,
+so --help and argument errors return immediately.
+"""
+import argparse
+import fnmatch
+import os
+import subprocess
+import sys
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_DATA_PATH = os.path.join(REPOSITORY_PATH, "data", "")
+
+# subcommand -> (stage module, input directory relative to the data directory)
+STAGES = {
+    'stage1': ('stage_1_processing', "parsed/"),
+    'stage2': ('stage_2_processing', "stage_1_processed/"),
+    'stage3': ('stage_3_processing', "stage_2_processed/"),
+    'stage4': ('stage_4_processing', "stage_3_processed/"),
+}
+
+
+def select_files(input_path: str, selectors: list or None) -> list or None:
+    """
+    Resolves file selectors against the files of a directory.
+    A selector is either an index ("12" selects 12.csv) or a glob pattern ("1*", "*.csv").
+    :param input_path: directory to select from
+    :param selectors: list of selectors, or None for every file
+    :return: sorted list of selected file names, or None for every file
+    """
+    if not selectors:
+        return None
+    available = sorted(os.listdir(input_path)) if os.path.exists(input_path) else []
+    selected = set()
+    for selector in selectors:
+        matches = [f"{selector}.csv"] if selector.isdigit() else fnmatch.filter(available, selector)
+        matches = [f for f in matches if f in available]
+        if not matches:
+            raise SystemExit(f"No file in {input_path} matches {selector!r}")
+        selected.update(matches)
+    return sorted(selected)
+
+
+def run_options(args) -> dict:
+    return {'resume': not args.no_resume, 'retry_failed': args.retry_failed}
+
+
+def stage_options(args, command: str) -> dict:
+    options = run_options(args)
+    # only stages 2 and 3 have an adaptive path, each with its own default
+    if command in ('stage2', 'stage3') and getattr(args, 'adaptive', None) is not None:
+        options['adaptive'] = args.adaptive
+    return options
+
+
+def run_parse(args) -> None:
+    # the Rust indexer/parser resolves data/ relative to the repository root
+    if os.path.abspath(args.data_root) != os.path.abspath(DEFAULT_DATA_PATH):
+        raise SystemExit(f"parse only supports the repository's data directory ({DEFAULT_DATA_PATH})")
+    raise SystemExit(subprocess.run(['cargo', 'run', '--release'], cwd=REPOSITORY_PATH).returncode)
+
+
+def run_stage_command(args) -> None:
+    module_name, input_directory = STAGES[args.command]
+    filenames = select_files(args.data_root + input_directory, args.files)
+    module = __import__(module_name)
+    module.main(data_path=args.data_root, filenames=filenames, **stage_options(args, args.command))
+
+
+def run_tokens(args) -> None:
+    # stages 1 to 3 share file names, so the selection made on the parsed files holds for every stage,
+    # minus the files an earlier stage skipped or failed on (they have no input in the next stage)
+    filenames = select_files(args.data_root + STAGES['stage1'][1], args.files)
+    for command in ('stage1', 'stage2', 'stage3'):
+        module_name, input_directory = STAGES[command]
+        if filenames is not None:
+            input_path = args.data_root + input_directory
+            filenames = [f for f in filenames if os.path.isfile(input_path + f)]
+        module = __import__(module_name)
+        module.main(data_path=args.data_root, filenames=filenames, **stage_options(args, command))
+
+
+def run_export(args) -> None:
+    input_path = args.input if args.input else args.data_root + "stage_3_processed/"
+    filenames = select_files(os.path.join(input_path, ""), args.files)
+
+    from shard_export import export_shards
+    manifest = export_shards(custom_input_directory=os.path.join(input_path, ""),
+                             custom_output_directory=os.path.join(args.output, "") if args.output else None,
+                             shard_format=args.format, rows_per_shard=args.rows_per_shard,
+                             data_path=args.data_root, filenames=filenames)
+    print(f"{len(manifest['shards'])} shards, {manifest['songs']} songs, {manifest['rows']} rows")
+
+
+def run_align(args) -> None:
+    from frame_alignment import main as align
+    align(custom_input_directory=os.path.join(args.input, "") if args.input else None,
+          custom_output_directory=os.path.join(args.output, "") if args.output else None,
+          default_fps=args.fps, data_path=args.data_root)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="cli.py", description="Karaoke subtitle dataset pipeline.")
+    parser.add_argument('--data-root', default=DEFAULT_DATA_PATH,
+                        help=f"data directory (default: {DEFAULT_DATA_PATH})")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('parse', help="index data/raw/ and parse the VTT files (runs src/main.rs)")
+
+    selection = argparse.ArgumentParser(add_help=False)
+    selection.add_argument('--files', nargs='+', metavar='FILE',
+                           help="indexes (e.g. 12) or glob patterns (e.g. '1*') of the files to process")
+    journal = argparse.ArgumentParser(add_help=False)
+    journal.add_argument('--no-resume', action='store_true', help="reprocess files completed by a previous run")
+    journal.add_argument('--retry-failed', action='store_true', help="retry files that failed in a previous run")
+
+    engine = argparse.ArgumentParser(add_help=False)
+    engine_paths = engine.add_mutually_exclusive_group()
+    engine_paths.add_argument('--adaptive', dest='adaptive', action='store_true', default=None,
+                              help="send static and single-run cue groups through the cheap path "
+                                   "(default for stage 3)")
+    engine_paths.add_argument('--reference', dest='adaptive', action='store_false',
+                              help="send every cue group through generate_tokens / process_duplicates "
+                                   "(default for stage 2, where nearly every cue group is progressive)")
+
+    for command, (module_name, input_directory) in STAGES.items():
+        parents = [selection, journal, engine] if command in ('stage2', 'stage3') else [selection, journal]
+        subparsers.add_parser(command, parents=parents, help=f"run {module_name}.py on data/{input_directory}")
+    subparsers.add_parser('tokens', parents=[selection, journal, engine],
+                          help="run stages 1 to 3 (data/parsed/ -> data/stage_3_processed/)")
+
+    export = subparsers.add_parser('export', parents=[selection],
+                                   help="export token CSVs to shards for training loaders")
+    export.add_argument('--input', help="token CSV directory (default: data/stage_3_processed/)")
+    export.add_argument('--output', help="shard directory (default: data/shards/)")
+    export.add_argument('--format', choices=['tar', 'jsonl.gz'], default='tar')
+    export.add_argument('--rows-per-shard', type=int, default=20000)
+
+    align = subparsers.add_parser('align', help="precompute frame -> token arrays for the songs with a video "
+                                                "in data/indexed/videos/")
+    align.add_argument('--input', help="token CSV directory (default: data/stage_3_processed/)")
+    align.add_argument('--output', help="array directory (default: data/frame_alignment/)")
+    align.add_argument('--fps', type=float, default=30.0, help="frame rate used when it cannot be read from a video")
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.data_root = os.path.join(os.path.abspath(args.data_root), "")
+
+    # the stage scripts import their helpers as top-level modules
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    if args.command == 'parse':
+        run_parse(args)
+    elif args.command in STAGES:
+        run_stage_command(args)
+    elif args.command == 'tokens':
+        run_tokens(args)
+    elif args.command == 'export':
+        run_export(args)
+    else:
+        run_align(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import json
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+META_NAME = "meta.json"
+
+# value of frames during which no token of the line is displayed
+NO_TOKEN = -1
+
+
+def probe_fps(video_file_path: str) -> float or None:
+    """
+    Reads the frame rate of a video with ffprobe (if it is installed).
+    :param video_file_path: path to the video
+    :return: frames per second, or None if it could not be determined
+    """
+    if shutil.which('ffprobe') is None:
+        return None
+    result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                             '-show_entries', 'stream=avg_frame_rate', '-of', 'csv=p=0', video_file_path],
+                            capture_output=True, text=True)
+    try:
+        numerator, _, denominator = result.stdout.strip().partition('/')
+        fps = float(numerator) / float(denominator or 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+    return fps if fps > 0 else None
+
+
+def frame_token_array(df: pd.DataFrame, fps: float, n_frames: int) -> np.ndarray:
+    """
+    Maps every frame to the token displayed during it.
+    Frame i (at time i / fps) belongs to a token if start <= i / fps < end.
+    If tokens of the df overlap, the one that starts last wins.
+    :param df: tokens of a single line, with 'start' and 'end' columns (seconds)
+    :param fps: frames per second
+    :param n_frames: number of frames
+    :return: int32 array of token ids (positions in df) per frame, NO_TOKEN where nothing is displayed
+    """
+    frames = np.full(n_frames, NO_TOKEN, dtype=np.int32)
+    # rounding guards against timestamps such as 0.7 * 30 = 20.999999999999996
+    first = np.ceil((df['start'].to_numpy() * fps).round(6)).astype(np.int64)
+    last = np.ceil((df['end'].to_numpy() * fps).round(6)).astype(np.int64)
+    token_ids = np.arange(len(df), dtype=np.int32)
+
+    for i in np.argsort(first, kind='stable').tolist():
+        frames[first[i]:last[i]] = token_ids[i]
+
+    return frames
+
+
+def align_song(df: pd.DataFrame, output_path: str, fps: float) -> dict:
+    """
+    Saves one frame -> token array per 'line' of a song as line_{line}.npy, along with meta.json.
+    Token ids are row positions in the song's token CSV.
+    :param df: tokens of the song, with 'start', 'end' and 'line' columns
+    :param output_path: directory of the song's arrays
+    :param fps: frames per second
+    :return: metadata of the song
+    """
+    if not os.path.exists(os.path.abspath(output_path)):
+        os.makedirs(os.path.abspath(output_path))
+
+    df = df.reset_index(drop=True)
+    n_frames = int(np.ceil((df['end'].max() * fps).round(6))) if len(df) else 0
+
+    lines = sorted(df['line'].unique().tolist())
+    for line in lines:
+        rows = df.index[df['line'] == line].to_numpy()
+        # token ids are relative to the whole song, not to the line
+        frames = frame_token_array(df.loc[rows], fps, n_frames)
+        frames[frames != NO_TOKEN] = rows[frames[frames != NO_TOKEN]]
+        np.save(os.path.abspath(os.path.join(output_path, f"line_{line}.npy")), frames)
+
+    meta = {'fps': fps, 'frames': n_frames, 'lines': lines}
+    with open(os.path.abspath(os.path.join(output_path, META_NAME)), 'w') as f:
+        json.dump(meta, f)
+
+    return meta
+
+
+def read_frame_tokens(song_path: str, line: int, start_frame: int = 0, stop_frame: int = None) -> np.ndarray:
+    """
+    Returns the token ids of frames [start_frame, stop_frame) of a line.
+    The array is memory-mapped, so only the requested range is read from disk.
+    :param song_path: directory of the song's arrays
+    :param line: 'line' value
+    :param start_frame: first frame
+    :param stop_frame: end frame (exclusive), by default the last frame of the song
+    :return: int32 array of token ids, NO_TOKEN for frames without a token
+             (and for frames past the end of the song)
+    """
+    array_path = os.path.abspath(os.path.join(song_path, f"line_{line}.npy"))
+    frames = np.load(array_path, mmap_mode='r')
+    if stop_frame is None:
+        stop_frame = len(frames)
+
+    out = np.full(max(stop_frame - start_frame, 0), NO_TOKEN, dtype=np.int32)
+    available = frames[max(start_frame, 0):max(min(stop_frame, len(frames)), 0)]
+    offset = max(-start_frame, 0)
+    out[offset:offset + len(available)] = available
+    return out
+
+
+def main(custom_input_directory=None, custom_output_directory=None, default_fps: float = 30.0,
+         data_path: str = "../data/"):
+    """
+    Precomputes frame -> token arrays for every song that has a video in data/indexed/videos/.
+    :param custom_input_directory: by default, will look at data/stage_3_processed/.
+    :param custom_output_directory: by default, will output to data/frame_alignment/.
+    :param default_fps: frame rate used when it cannot be read from the video
+    :param data_path: data directory
+    :return:
+    """
+    input_path = custom_input_directory if custom_input_directory else data_path + "stage_3_processed/"
+    output_path = custom_output_directory if custom_output_directory else data_path + "frame_alignment/"
+    video_path = data_path + "indexed/videos/"
+
+    if not os.path.exists(os.path.abspath(video_path)):
+        print("Video directory does not exist. Videos must be indexed with include_and_require_videos=true.")
+        return
+
+    for video in os.listdir(os.path.abspath(video_path)):
+        if not video.endswith('.webm'):
+            continue
+        idx = video[:-len('.webm')]
+        csv_file = os.path.abspath(input_path + idx + ".csv")
+        if not os.path.exists(csv_file):
+            print(f"Skipping {video} because it has no tokens.")
+            continue
+
+        fps = probe_fps(os.path.abspath(video_path + video)) or default_fps
+        with open(csv_file) as f:
+            df = pd.read_csv(f, keep_default_na=False, na_values=[""])
+        align_song(df, output_path + idx + "/", fps)
+
+
+if __name__ == '__main__':
+    from cli import DEFAULT_DATA_PATH
+    main(custom_input_directory=None, custom_output_directory=None, data_path=DEFAULT_DATA_PATH)
@@ -0,0 +1,191 @@
+import argparse
+import io
+import os
+import time
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import stage_1_processing
+from cli import DEFAULT_DATA_PATH
+import stage_2_processing
+import stage_3_processing
+
+# (input directory, golden output directory) of each stage, relative to the data directory
+STAGE_DIRECTORIES = {
+    'stage_1': ("parsed/", "stage_1_processed/"),
+    'stage_2': ("stage_1_processed/", "stage_2_processed/"),
+    'stage_3': ("stage_2_processed/", "stage_3_processed/"),
+}
+
+# columns compared with a tolerance instead of exactly
+TIMESTAMP_COLUMNS = ['start', 'end']
+
+# engine name -> {stage name -> process_file(f) function}
+ENGINES = {
+    'reference': {
+        'stage_1': stage_1_processing.process_file,
+        'stage_2': partial(stage_2_processing.process_file, adaptive=False),
+        'stage_3': partial(stage_3_processing.process_file, adaptive=False),
+    },
+}
+
+
+def register_engine(name: str, stages: dict) -> None:
+    """
+    Registers an alternative implementation of one or more stages.
+    Stages that are not given fall back to the reference implementation.
+    :param name: engine name
+    :param stages: {stage name -> process_file(f) function returning a DataFrame or None}
+    """
+    ENGINES[name] = {**ENGINES['reference'], **stages}
+
+
+register_engine('adaptive', {
+    'stage_2': partial(stage_2_processing.process_file, adaptive=True),
+    'stage_3': partial(stage_3_processing.process_file, adaptive=True),
+})
+
+
+def _round_trip(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Writes df to CSV and reads it back, so engine outputs are compared exactly as they would be stored.
+    """
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False)
+    buffer.seek(0)
+    return _read_output(buffer)
+
+
+def _read_output(f) -> pd.DataFrame:
+    # tokens such as "null" or "n/a" are valid lyrics, only empty cells are missing values
+    return pd.read_csv(f, keep_default_na=False, na_values=[""])
+
+
+def diff_frames(expected: pd.DataFrame, actual: pd.DataFrame, tolerance: float = 0.001) -> list:
+    """
+    Compares two outputs row by row.
+    :param expected: golden output
+    :param actual: engine output
+    :param tolerance: absolute tolerance (in seconds) for the timestamp columns
+    :return: list of mismatches, each a dict with 'row', 'column', 'expected' and 'actual'
+    """
+    if list(expected.columns) != list(actual.columns):
+        return [{'row': None, 'column': None, 'expected': list(expected.columns), 'actual': list(actual.columns)}]
+
+    mismatches = []
+    if len(expected) != len(actual):
+        mismatches.append({'row': None, 'column': 'rows', 'expected': len(expected), 'actual': len(actual)})
+    n = min(len(expected), len(actual))
+
+    for column in expected.columns:
+        a = expected[column].to_numpy()[:n]
+        b = actual[column].to_numpy()[:n]
+        if column in TIMESTAMP_COLUMNS:
+            equal = np.isclose(a.astype(float), b.astype(float), rtol=0, atol=tolerance, equal_nan=True)
+        else:
+            equal = (a == b) | (pd.isna(a) & pd.isna(b))
+        for row in np.flatnonzero(~equal).tolist():
+            mismatches.append({'row': row, 'column': column, 'expected': a[row], 'actual': b[row]})
+
+    return mismatches
+
+
+def _run_stage(process_file, path: str) -> tuple[pd.DataFrame or None, float]:
+    with open(path) as f:
+        t0 = time.perf_counter()
+        df = process_file(f)
+        elapsed = time.perf_counter() - t0
+    return df, elapsed
+
+
+def check_stage(stage: str, engine: str = 'reference', data_path: str = "../data/", filenames: list = None,
+                golden_directory: str = None, tolerance: float = 0.001) -> dict:
+    """
+    Runs a stage of the given engine over its input files and diffs the results against the golden outputs.
+    The reference engine is timed over the same files so that the speedup can be reported alongside.
+    :param stage: stage name (see STAGE_DIRECTORIES)
+    :param engine: engine name (see ENGINES)
+    :param data_path: data directory
+    :param filenames: files to check (by default, every file in the stage's input directory)
+    :param golden_directory: by default, the stage's output directory in data_path
+    :param tolerance: absolute tolerance (in seconds) for the timestamp columns
+    :return: dict with 'files', 'mismatches' ({filename -> list of mismatches}), 'engine_seconds',
+             'reference_seconds' and 'speedup'
+    """
+    input_directory, default_golden_directory = STAGE_DIRECTORIES[stage]
+    input_path = data_path + input_directory
+    golden_path = golden_directory if golden_directory else data_path + default_golden_directory
+    if filenames is None:
+        filenames = sorted(os.listdir(os.path.abspath(input_path)))
+
+    mismatches = {}
+    engine_seconds = 0.0
+    reference_seconds = 0.0
+    for filename in filenames:
+        path = os.path.abspath(input_path + filename)
+        df, elapsed = _run_stage(ENGINES[engine][stage], path)
+        engine_seconds += elapsed
+        if engine == 'reference':
+            reference_seconds += elapsed
+        else:
+            reference_seconds += _run_stage(ENGINES['reference'][stage], path)[1]
+
+        golden_file = os.path.abspath(golden_path + filename)
+        if df is None or not os.path.exists(golden_file):
+            # skipped files must be skipped by both
+            if (df is None) != (not os.path.exists(golden_file)):
+                mismatches[filename] = [{'row': None, 'column': None,
+                                         'expected': os.path.exists(golden_file), 'actual': df is not None}]
+            continue
+
+        with open(golden_file) as f:
+            expected = _read_output(f)
+        file_mismatches = diff_frames(expected, _round_trip(df), tolerance)
+        if file_mismatches:
+            mismatches[filename] = file_mismatches
+
+    return {
+        'files': len(filenames),
+        'mismatches': mismatches,
+        'engine_seconds': engine_seconds,
+        'reference_seconds': reference_seconds,
+        'speedup': reference_seconds / engine_seconds if engine_seconds else float('nan'),
+    }
+
+
+def print_report(stage: str, engine: str, result: dict, max_mismatches: int = 5) -> None:
+    n_bad = len(result['mismatches'])
+    print(f"{stage} [{engine}]: {result['files'] - n_bad}/{result['files']} files match, "
+          f"{result['engine_seconds']:.3f}s vs {result['reference_seconds']:.3f}s reference "
+          f"(speedup x{result['speedup']:.2f})")
+    for filename, file_mismatches in result['mismatches'].items():
+        print(f"  {filename}: {len(file_mismatches)} mismatches")
+        for mismatch in file_mismatches[:max_mismatches]:
+            print(f"    row {mismatch['row']}, column {mismatch['column']}: "
+                  f"expected {mismatch['expected']!r}, got {mismatch['actual']!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Diffs a processing engine's outputs against the golden outputs.")
+    parser.add_argument('--engine', default='reference', choices=sorted(ENGINES))
+    parser.add_argument('--stages', nargs='+', default=list(STAGE_DIRECTORIES), choices=list(STAGE_DIRECTORIES))
+    parser.add_argument('--data-path', default=DEFAULT_DATA_PATH,
+                        help=f"data directory (default: {DEFAULT_DATA_PATH})")
+    parser.add_argument('--files', nargs='+', default=None, help="file names to check (default: all)")
+    parser.add_argument('--tolerance', type=float, default=0.001, help="timestamp tolerance in seconds")
+    args = parser.parse_args()
+    args.data_path = os.path.join(os.path.abspath(args.data_path), "")
+
+    failed = False
+    for stage in args.stages:
+        result = check_stage(stage, args.engine, args.data_path, args.files, tolerance=args.tolerance)
+        print_report(stage, args.engine, result)
+        failed = failed or bool(result['mismatches'])
+
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,20 @@
 import os
 from processing_utils import *
+from run_journal import run_stage, write_csv_atomic
+from text_normalization import filter_lines, normalize_text, profile_for
 
 
-def process_file(f) -> pd.DataFrame or None:
+def process_file(f, language: str = None) -> pd.DataFrame or None:
     """
     Generates a dataset containing token information.
 
     Note that it is up to the user to do further munging.
     :param f: CSV file containing data parsed from a WebVTT file (with formatting).
+    :param language: subtitle language (see index.tsv), selects the normalization options.
     :return: A processed DataFrame containing token information.
     """
+    profile = profile_for(language)
+
     df = pd.read_csv(f)
     # if the df has less than 3 rows, then skip it
     if len(df) < 3:
@@ -17,17 +22,16 @@ def process_file(f) -> pd.DataFrame or None:
         return None
 
     df = df.drop_duplicates()
-    # df = filter_rows(df)  # !!! NOTE that this is only for EN subtitles
+    df = filter_lines(df, profile)
 
     # if there are any nulls, print
     if df.isnull().values.any():
-        print(f + " has null values")
+        print(f"{os.path.basename(f.name)} has null values")
         df = df.dropna(how='any', axis=0)
 
     df = convert_time(df)
 
-    df['text'] = df['text'].apply(lambda x: x.replace("'", "\\'"))
-    df['text'] = df['text'].str.lower()
+    df['text'] = normalize_text(df['text'], profile)
 
     df['unformatted'] = df['text'].apply(unformatted)
     # drop columns where 'unformatted' is empty
@@ -64,40 +68,34 @@ def process_file(f) -> pd.DataFrame or None:
     return df
 
 
-def main(custom_input_directory=None, custom_output_directory=None):
+def main(custom_input_directory=None, custom_output_directory=None, data_path="../data/", filenames=None,
+         **run_options):
     """
     Processes the parsed data and generates a dataset containing timestamped tokens.
     :param custom_input_directory: by default, will look at data/parsed/.
     :param custom_output_directory: by default, will output to data/final_dataset/.
+    :param data_path: data directory
+    :param filenames: files to process (by default, every file in the input directory)
+    :param run_options: passed to run_stage (e.g. resume, retry_failed)
     :return:
     """
-    data_path = "../data/"
     input_path = custom_input_directory if custom_input_directory else data_path + "parsed/"
     output_path = custom_output_directory if custom_output_directory else data_path + "final_dataset/"
     index_file_path = data_path + "indexed/index.tsv"
-
-    for filename in os.listdir(os.path.abspath(input_path)):
-        with open(os.path.abspath(input_path + filename)) as f:
-
-            df = process_file(f)
-            if df is None:
-                continue
-
-            # if the directory does not exist, create it
-            csv_output = output_path + "/csvs/"
-            if not os.path.exists(os.path.abspath(csv_output)):
-                os.makedirs(os.path.abspath(csv_output))
-
-            df.to_csv(os.path.abspath(csv_output + filename), index=False)
-
-        # index file
-        idx_path = os.path.abspath(index_file_path)
-        if os.path.exists(idx_path):
-            with open(idx_path) as f:
-                df = pd.read_csv(f, sep='\t')
-                df.to_csv(os.path.abspath(output_path + "index.tsv"), sep='\t', index=False)
-        else:
-            print("Index file does not exist. If this is intended, please ignore this message.")
+    index = read_index(index_file_path)
+
+    run_stage("tokens", process_file, input_path, output_path + "/csvs/",
+              data_path=data_path, filenames=filenames, **run_options,
+              process_kwargs=lambda filename: {'language': file_language(filename, index)})
+
+    # index file
+    idx_path = os.path.abspath(index_file_path)
+    if os.path.exists(idx_path):
+        with open(idx_path) as f:
+            df = pd.read_csv(f, sep='\t')
+            write_csv_atomic(df, output_path + "index.tsv", sep='\t', index=False)
+    else:
+        print("Index file does not exist. If this is intended, please ignore this message.")
 
 
 if __name__ == '__main__':
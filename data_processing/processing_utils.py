@@ -1,6 +1,13 @@
 import pandas as pd
+import numpy as np
+import heapq
+import os
 import re
 import ast
+from itertools import chain
+from operator import itemgetter
+
+from text_normalization import is_credit, strip_punctuation, unescape_html
 
 
 def convert_time(df: pd.DataFrame) -> pd.DataFrame:
@@ -61,6 +68,50 @@ def convert_segments_to_tuples(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
+def encode_segments(segments: pd.Series) -> dict:
+    """
+    Flattens a 'segments' column (lists of (color, char) tuples) into flat arrays.
+    Row i owns the entries offsets[i]:offsets[i + 1] of 'colors' and 'chars'.
+    :param segments: 'segments' column
+    :return: dict with 'offsets' (int64), 'colors' (int32), 'chars' (int32 codes) and 'dictionary' (list of str)
+    """
+    lengths = np.fromiter((len(x) for x in segments), dtype=np.int64, count=len(segments))
+    offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    flat = list(chain.from_iterable(segments))
+    if not flat:
+        return {'offsets': offsets, 'colors': np.empty(0, dtype=np.int32),
+                'chars': np.empty(0, dtype=np.int32), 'dictionary': []}
+    # (unpacking millions of tuples with zip(*flat) is an order of magnitude slower)
+    colors = list(map(itemgetter(0), flat))
+    chars = list(map(itemgetter(1), flat))
+    codes, dictionary = pd.factorize(np.array(chars, dtype=object))
+
+    return {'offsets': offsets, 'colors': np.array(colors, dtype=np.int32),
+            'chars': codes.astype(np.int32), 'dictionary': list(dictionary)}
+
+
+def decode_segments(offsets: np.ndarray, colors: np.ndarray, chars: np.ndarray, dictionary: list,
+                    rows=None) -> list:
+    """
+    Inverse of encode_segments.
+    :param rows: positions of the rows to decode (by default, every row)
+    :return: list (one entry per decoded row) of lists of (color, char) tuples
+    """
+    if rows is None:
+        color_list = colors.tolist()
+        char_list = [dictionary[c] for c in chars.tolist()]
+        bounds = offsets.tolist()
+        return [list(zip(color_list[a:b], char_list[a:b])) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    decoded = []
+    for row in rows:
+        a, b = int(offsets[row]), int(offsets[row + 1])
+        decoded.append(list(zip(colors[a:b].tolist(), [dictionary[c] for c in chars[a:b].tolist()])))
+    return decoded
+
+
 def compute_ref_start_end(df: pd.DataFrame) -> pd.DataFrame:
     """
     Assumes dataframe is sorted unformatted ascending, start descending.
@@ -177,19 +228,25 @@ def generate_tokens(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def process_duplicates(df: pd.DataFrame) -> pd.DataFrame:
-    def process_dupe_ref_end(input_row):
-        ref_color = input_row['segments'][-1][0]
-
-        idx = -1
-        for color, char in input_row['segments'][::-1]:
-            if color != ref_color:
-                out = ''.join([char for _, char in input_row['segments'][:idx+1]])
-                return "<dupe_ref_end_1>" if out == "" else out
-            idx -= 1
-        out = input_row['unformatted']
-        return "<dupe_ref_end_2>" if out == "" else out
+def process_dupe_ref_end(input_row):
+    """
+    Resolves a "<dupe_ref_end>" token: everything before the trailing run of the last segment's color.
+    :param input_row: row with 'segments' and 'unformatted'
+    :return: token
+    """
+    ref_color = input_row['segments'][-1][0]
+
+    idx = -1
+    for color, char in input_row['segments'][::-1]:
+        if color != ref_color:
+            out = ''.join([char for _, char in input_row['segments'][:idx+1]])
+            return "<dupe_ref_end_1>" if out == "" else out
+        idx -= 1
+    out = input_row['unformatted']
+    return "<dupe_ref_end_2>" if out == "" else out
+
 
+def process_duplicates(df: pd.DataFrame) -> pd.DataFrame:
     # apply process_dupe_ref_end to all rows
     # with token = "<dupe_ref_end>"
     df['token'] = df.apply(lambda x: process_dupe_ref_end(x) if x['token'] == '<dupe_ref_end>' else x['token'], axis=1)
@@ -235,8 +292,257 @@ def process_duplicates(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def filter_tokens(df: pd.DataFrame) -> pd.DataFrame:
+def classify_cue_groups(df: pd.DataFrame, column: str = 'segments') -> pd.Series:
+    """
+    Assumes compute_ref_start_end was applied (a cue group starts at every ref_start row).
+    Classifies each row by the kind of cue group it belongs to:
+    - 'static': the group is a single cue (ref_start and ref_end), its token is its whole text
+    - 'single_run': the group has several cues, but its highlighting never changes
+    - 'progressive': the highlighting changes within the group, tokens must be generated by comparing cues
+    Classifying on the formatted 'text' (before the segments are built) is safe:
+    cues with the same text have the same segments, so a 'single_run' group on 'text' is one on 'segments' too.
+    :param df: with 'ref_start' column and the column to compare
+    :param column: 'segments', or 'text'
+    :return: series of cue paths, aligned with df
+    """
+    if len(df) == 0:
+        return pd.Series([], index=df.index, dtype=object)
+    ref_start = df['ref_start'].to_numpy(dtype=bool)
+    # the first row always starts a group
+    starts = np.flatnonzero(ref_start | (np.arange(len(df)) == 0))
+    group_size = np.diff(np.append(starts, len(df)))
+
+    values = df[column].tolist()
+    changes = np.zeros(len(df), dtype=bool)
+    changes[1:] = [a != b for a, b in zip(values[1:], values[:-1])]
+    # the first row of a group is never compared to the previous group
+    changes[starts] = False
+    group_changes = np.add.reduceat(changes, starts) > 0
+
+    group_paths = np.where(group_size == 1, 'static', np.where(group_changes, 'progressive', 'single_run'))
+    return pd.Series(np.repeat(group_paths, group_size).astype(object), index=df.index)
+
+
+def cue_path_counts(paths: pd.Series) -> dict:
+    """
+    :param paths: cue paths (see classify_cue_groups)
+    :return: {cue path -> number of rows}
+    """
+    return {path: int((paths == path).sum()) for path in ('static', 'single_run', 'progressive')}
 
-    # remove all characters that
+
+def create_character_segments_adaptive(df: pd.DataFrame, paths: pd.Series) -> pd.Series:
+    """
+    Same segments as create_segments, clean_segments and create_character_segments,
+    but the cues of 'static' and 'single_run' groups (see classify_cue_groups) are parsed once per distinct text.
+    :param df: with 'text' column
+    :param paths: cue paths, aligned with df
+    :return: 'segments' column, aligned with df
+    """
+    progressive = (paths == 'progressive').to_numpy()
+    segments = np.empty(len(df), dtype=object)
+    if progressive.any():
+        parsed = create_character_segments(clean_segments(create_segments(df.loc[progressive, ['text']].copy())))
+        segments[progressive] = parsed['segments'].to_numpy()
+    if not progressive.all():
+        codes, texts = pd.factorize(df['text'][~progressive])
+        parsed = create_character_segments(clean_segments(create_segments(pd.DataFrame({'text': texts}))))
+        segments[~progressive] = parsed['segments'].to_numpy()[codes]
+    return pd.Series(segments, index=df.index)
+
+
+def generate_tokens_adaptive(df: pd.DataFrame, paths: pd.Series = None) -> pd.DataFrame:
+    """
+    Same output as generate_tokens, but only 'progressive' cue groups (see classify_cue_groups)
+    go through the character comparison, the token of every other row is emitted directly.
+    The number of rows that took each path is stored in df.attrs['cue_paths'].
+    :param df: with 'segments', 'ref_start' and 'ref_end' columns
+    :param paths: cue paths, if already classified (by default, classified on 'segments')
+    :return: modified df with 'token' column
+    """
+    if paths is None:
+        paths = classify_cue_groups(df)
+    static = (paths == 'static').to_numpy()
+    single_run = (paths == 'single_run').to_numpy()
+    progressive = (paths == 'progressive').to_numpy()
+    cue_paths = cue_path_counts(paths)
+
+    if progressive.all():
+        df = generate_tokens(df)
+        df.attrs['cue_paths'] = cue_paths
+        return df
+
+    tokens = np.empty(len(df), dtype=object)
+    tokens[static] = [''.join([char for _, char in x]) for x in df['segments'][static]]
+    # a group that never changes only yields duplicates, resolved in process_duplicates
+    tokens[single_run] = np.where(df['ref_end'][single_run].astype(bool), "<dupe_ref_end>", "<dupe>")
+    if progressive.any():
+        tokens[progressive] = generate_tokens(df[progressive].copy())['token'].to_numpy()
+
+    df['token'] = tokens
+    df = df.drop(columns=['time_diff', 'unf_diff', 'line_diff'])
+    df.attrs['cue_paths'] = cue_paths
 
     return df
+
+
+def process_duplicates_adaptive(df: pd.DataFrame, encoded_segments: dict = None) -> pd.DataFrame:
+    """
+    Same output as process_duplicates, but only rows holding a placeholder token are visited.
+    :param df: with 'unformatted' and 'token' columns, and 'segments' unless encoded_segments is given
+    :param encoded_segments: the rows' segments as encoded by encode_segments (e.g. left in shared memory),
+                             only the "<dupe_ref_end>" rows are decoded
+    :return: modified df with resolved tokens and a 'dupe' column
+    """
+    dupe_ref_end = (df['token'] == '<dupe_ref_end>').to_numpy()
+    if dupe_ref_end.any():
+        rows = df[dupe_ref_end]
+        if encoded_segments is not None:
+            segments = decode_segments(**encoded_segments, rows=np.flatnonzero(dupe_ref_end).tolist())
+            rows = rows.assign(segments=pd.Series(segments, index=rows.index, dtype=object))
+        tokens = df['token'].to_numpy(dtype=object, copy=True)
+        tokens[dupe_ref_end] = [process_dupe_ref_end(row) for _, row in rows.iterrows()]
+        df['token'] = tokens
+
+    df['dupe'] = df['token'].isin(['<dupe>', '<dupe_ref_end>'])
+    # a "<dupe>" takes the token of the next row that is not a "<dupe>" (if there is one)
+    dupe = (df['token'] == '<dupe>').to_numpy()
+    if dupe.any():
+        n = len(df)
+        next_non_dupe = np.minimum.accumulate(np.where(dupe, n, np.arange(n))[::-1])[::-1]
+        resolved = dupe & (next_non_dupe < n)
+        tokens = df['token'].to_numpy(dtype=object, copy=True)
+        tokens[resolved] = tokens[next_non_dupe[resolved]]
+        df['token'] = tokens
+
+    return df
+
+
+def interval_overlap_join(a_start, a_end, b_start, b_end) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Finds every pair of overlapping intervals between two sets of [start, end) intervals
+    with a single sweep over the sorted start times, in O((n + m) log(n + m) + k) for k overlapping pairs.
+    Intervals that merely touch (end == start) do not overlap.
+    :param a_start: start times of the first set
+    :param a_end: end times of the first set
+    :param b_start: start times of the second set
+    :param b_end: end times of the second set
+    :return: (positions into a, positions into b, overlap in seconds) of every overlapping pair
+    """
+    starts = np.concatenate([np.asarray(a_start, dtype=float), np.asarray(b_start, dtype=float)])
+    ends = np.concatenate([np.asarray(a_end, dtype=float), np.asarray(b_end, dtype=float)])
+    n_a = len(a_start)
+
+    pairs_a, pairs_b = [], []
+    # active intervals of each set, as min-heaps keyed by end time
+    active = ([], [])
+    for i in np.argsort(starts, kind='stable').tolist():
+        start, end = starts[i], ends[i]
+        if end <= start:
+            continue
+        side = 0 if i < n_a else 1
+        for heap in active:
+            while heap and heap[0][0] <= start:
+                heapq.heappop(heap)
+        # everything still active on the other side overlaps the current interval
+        for _, j in active[1 - side]:
+            if side == 0:
+                pairs_a.append(i)
+                pairs_b.append(j - n_a)
+            else:
+                pairs_a.append(j)
+                pairs_b.append(i - n_a)
+        heapq.heappush(active[side], (end, i))
+
+    pairs_a = np.array(pairs_a, dtype=np.int64)
+    pairs_b = np.array(pairs_b, dtype=np.int64)
+    overlap = (np.minimum(ends[pairs_a], ends[pairs_b + n_a]) - np.maximum(starts[pairs_a], starts[pairs_b + n_a]))
+
+    return pairs_a, pairs_b, overlap.round(3)
+
+
+def pair_lines(df: pd.DataFrame, line_a: int = -1, line_b: int = 0) -> pd.DataFrame:
+    """
+    Pairs the tokens of two concurrent lines (e.g. lyrics and their furigana/translation) by time overlap.
+    Every token on either line is paired with the token on the other line it overlaps the most.
+    Adds 'pair_token', 'pair_unformatted' and 'pair_overlap' columns to the df
+    (left empty for tokens without a concurrent token, and for tokens on other lines).
+    :param df: with 'start', 'end', 'line', 'unformatted' and 'token' columns
+    :param line_a: 'line' value of the first line
+    :param line_b: 'line' value of the second line
+    :return: modified df
+    """
+    df = df.reset_index(drop=True)
+    a = df.index[df['line'] == line_a].to_numpy()
+    b = df.index[df['line'] == line_b].to_numpy()
+
+    pos_a, pos_b, overlap = interval_overlap_join(df.loc[a, 'start'], df.loc[a, 'end'],
+                                                  df.loc[b, 'start'], df.loc[b, 'end'])
+    pairs = pd.DataFrame({'row_a': a[pos_a], 'row_b': b[pos_b], 'overlap': overlap})
+
+    partner = np.full(len(df), -1, dtype=np.int64)
+    pair_overlap = np.full(len(df), np.nan)
+    for own, other in (('row_a', 'row_b'), ('row_b', 'row_a')):
+        # keep the largest overlap of every row (the earliest partner wins ties)
+        best = (pairs.sort_values(by=[own, 'overlap', other], ascending=[True, False, True])
+                .drop_duplicates(subset=[own], keep='first'))
+        partner[best[own].to_numpy()] = best[other].to_numpy()
+        pair_overlap[best[own].to_numpy()] = best['overlap'].to_numpy()
+
+    paired = partner != -1
+    df['pair_token'] = pd.Series(df['token'].to_numpy()[partner[paired]], index=df.index[paired])
+    df['pair_unformatted'] = pd.Series(df['unformatted'].to_numpy()[partner[paired]], index=df.index[paired])
+    df['pair_overlap'] = pair_overlap
+
+    return df
+
+
+# tokens emitted by generate_tokens and process_duplicates in place of a token
+PLACEHOLDER_PATTERN = r'<dupe(?:_ref_end(?:_\d)?)?>'
+
+
+def filter_tokens(df: pd.DataFrame, profile: dict) -> pd.DataFrame:
+    """
+    Removes credit lines and punctuation from the tokens, as configured by the language profile.
+    :param df: with 'unformatted' and 'token' columns
+    :param profile: see text_normalization.LANGUAGE_PROFILES
+    :return: filtered df
+    """
+    if profile['drop_credits']:
+        df = df[~is_credit(df['unformatted'])].copy()
+
+    if profile['strip_punctuation']:
+        # placeholders left unresolved by stages 2 and 3 (e.g. "<dupe_ref_end_1>") are kept as they are
+        placeholder = df['token'].str.fullmatch(PLACEHOLDER_PATTERN).fillna(False).astype(bool)
+        # entities are decoded first, so that "&amp;" loses its "&" rather than becoming "amp"
+        tokens = strip_punctuation(unescape_html(df['token']))
+        df['token'] = tokens.where(~placeholder, df['token'])
+        # tokens made only of punctuation, or of spaces (a decoded &nbsp;)
+        df = df[df['token'].str.strip() != '']
+
+    return df
+
+
+def read_index(index_file_path: str) -> dict:
+    """
+    :param index_file_path: path to index.tsv
+    :return: {index -> {'title', 'id', 'language'}}, empty if there is no index file
+    """
+    if not os.path.exists(os.path.abspath(index_file_path)):
+        print("Index file does not exist. If this is intended, please ignore this message.")
+        return {}
+    index = pd.read_csv(os.path.abspath(index_file_path), sep='\t', keep_default_na=False)
+    return {int(row['Index']): {'title': row['Title'], 'id': row['ID'], 'language': row['Language']}
+            for _, row in index.iterrows()}
+
+
+def file_language(filename: str, index: dict) -> str or None:
+    """
+    :param filename: name of a processed file, e.g. "12.csv"
+    :param index: see read_index
+    :return: the subtitle language of the file, or None if it is not indexed
+    """
+    stem = filename.split('.')[0]
+    if not stem.isdigit():
+        return None
+    return index.get(int(stem), {}).get('language')
@@ -0,0 +1,272 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import traceback
+
+import pandas as pd
+
+JOURNAL_NAME = "journal.jsonl"
+
+# stage_1 to stage_4 write data/stage_{n}_processed/
+LAST_STAGE = 4
+
+
+def journal_file(data_path: str = "../data/") -> str:
+    return os.path.abspath(data_path + "journal/" + JOURNAL_NAME)
+
+
+def append_entry(journal_path: str, entry: dict) -> None:
+    """
+    Appends an entry to the journal and flushes it to disk before returning (write-ahead).
+    :param journal_path: path to the journal file
+    :param entry: JSON-serializable entry
+    """
+    directory = os.path.dirname(journal_path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    line = json.dumps(entry, ensure_ascii=False) + "\n"
+    # an entry cut short by a crash must not swallow this one
+    if os.path.exists(journal_path) and os.path.getsize(journal_path) > 0:
+        with open(journal_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                line = "\n" + line
+    with open(journal_path, 'a') as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_journal(journal_path: str) -> dict:
+    """
+    Replays the journal.
+    A line that is not valid JSON (an entry cut short by a crash) is ignored.
+    :param journal_path: path to the journal file
+    :return: {(stage, filename) -> last entry}
+    """
+    state = {}
+    if not os.path.exists(journal_path):
+        return state
+    with open(journal_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            state[(entry['stage'], entry['file'])] = entry
+    return state
+
+
+def write_csv_atomic(df: pd.DataFrame, path: str, **kwargs) -> None:
+    """
+    Writes df to a temporary file next to path, then renames it to path,
+    so path never holds a partially written file.
+    :param df: DataFrame to write
+    :param path: destination
+    :param kwargs: passed to df.to_csv
+    """
+    path = os.path.abspath(path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', newline='') as f:
+            df.to_csv(f, **kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_file_atomic(payload: bytes, path: str) -> None:
+    """
+    Same as write_csv_atomic, for raw bytes.
+    :param payload: file content
+    :param path: destination
+    """
+    path = os.path.abspath(path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _input_signature(path: str) -> dict:
+    stat = os.stat(path)
+    return {'input_size': stat.st_size, 'input_mtime': stat.st_mtime_ns}
+
+
+def quarantine(input_file: str, stage: str, error: str, data_path: str = "../data/") -> str:
+    """
+    Copies a failing input file to data/quarantine/{stage}/, along with its traceback.
+    An input that can no longer be read (e.g. deleted since it was listed) only gets its traceback.
+    :param input_file: path to the input file
+    :param stage: stage name
+    :param error: formatted traceback
+    :param data_path: data directory
+    :return: path to the quarantined copy, or to the traceback if there is no copy
+    """
+    quarantine_path = os.path.abspath(data_path + "quarantine/" + stage)
+    if not os.path.exists(quarantine_path):
+        os.makedirs(quarantine_path)
+    destination = os.path.join(quarantine_path, os.path.basename(input_file))
+    with open(destination + ".traceback.txt", 'w') as f:
+        f.write(error)
+    if not os.path.isfile(input_file):
+        return destination + ".traceback.txt"
+    shutil.copyfile(input_file, destination)
+    return destination
+
+
+def later_stages(stage_no: int, data_path: str = "../data/") -> dict:
+    """
+    :param stage_no: number of a stage
+    :param data_path: data directory
+    :return: {stage name -> output directory} of the stages after stage_no
+    """
+    return {f"stage_{n}": data_path + f"stage_{n}_processed/" for n in range(stage_no + 1, LAST_STAGE + 1)}
+
+
+def _discard_outputs(journal_path: str, stage: str, filename: str, output_path: str, downstream: dict) -> None:
+    # a file without output in this stage must not keep the outputs of an earlier run in any later stage
+    if os.path.exists(os.path.abspath(output_path + filename)):
+        os.remove(os.path.abspath(output_path + filename))
+    for later_stage, later_output_path in downstream.items():
+        later_output_file = os.path.abspath(later_output_path + filename)
+        if os.path.exists(later_output_file):
+            os.remove(later_output_file)
+            append_entry(journal_path, {'stage': later_stage, 'file': filename, 'status': 'removed',
+                                        'time': time.time(), 'cause': stage})
+
+
+def run_stage(stage: str, process_file, input_path: str, output_path: str, data_path: str = "../data/",
+              filenames: list = None, process_kwargs=None, on_result=None, resume: bool = True,
+              retry_failed: bool = False, downstream: dict = None) -> dict:
+    """
+    Runs process_file over every input file, journaling each file's progress.
+    Outputs are written atomically, and a file that raises is quarantined instead of stopping the run.
+    A file that fails or is skipped is left without output, even if an earlier run produced one,
+    and so are the later stages (see downstream), whose outputs for it would otherwise be stale.
+    With resume, files whose last run completed (and whose input has not changed since) are not processed again.
+    :param stage: stage name, used to key the journal
+    :param process_file: process_file(f, **kwargs) returning a DataFrame, or None to skip the file
+    :param input_path: input directory
+    :param output_path: output directory
+    :param data_path: data directory (holds the journal and the quarantine)
+    :param filenames: files to process (by default, every file in input_path)
+    :param process_kwargs: optional function filename -> kwargs for process_file
+    :param on_result: optional function (filename, df) called with each processed DataFrame
+    :param resume: skip the files completed by a previous run
+    :param retry_failed: also process the files that failed in a previous run (otherwise they are skipped on resume)
+    :param downstream: {stage name -> output directory} of the later stages (see later_stages)
+    :return: number of files per status ('done', 'skipped', 'failed'), plus the files not processed again on resume:
+             'resumed' (completed previously) and 'failed_previously'
+    """
+    journal_path = journal_file(data_path)
+    state = load_journal(journal_path) if resume else {}
+    if not os.path.exists(os.path.abspath(output_path)):
+        os.makedirs(os.path.abspath(output_path))
+    if filenames is None:
+        # temporary files left by an interrupted write_csv_atomic are not inputs
+        filenames = sorted(f for f in os.listdir(os.path.abspath(input_path)) if not f.endswith('.tmp'))
+
+    summary = {'done': 0, 'skipped': 0, 'failed': 0, 'resumed': 0, 'failed_previously': 0}
+    for filename in filenames:
+        input_file = os.path.abspath(input_path + filename)
+        output_file = os.path.abspath(output_path + filename)
+        signature = {}
+        try:
+            signature = _input_signature(input_file)
+
+            last = state.get((stage, filename))
+            if last is not None and all(last.get(k) == v for k, v in signature.items()):
+                completed = (last['status'] == 'done' and os.path.exists(output_file)) or last['status'] == 'skipped'
+                if completed:
+                    summary['resumed'] += 1
+                    continue
+                if last['status'] == 'failed' and not retry_failed:
+                    summary['failed_previously'] += 1
+                    continue
+
+            append_entry(journal_path, {'stage': stage, 'file': filename, 'status': 'started', 'time': time.time()})
+            with open(input_file) as f:
+                df = process_file(f, **(process_kwargs(filename) if process_kwargs else {}))
+            if df is not None:
+                write_csv_atomic(df, output_file, index=False)
+                if on_result is not None:
+                    on_result(filename, df)
+            else:
+                _discard_outputs(journal_path, stage, filename, output_path, downstream or {})
+        except Exception:
+            error = traceback.format_exc()
+            _discard_outputs(journal_path, stage, filename, output_path, downstream or {})
+            destination = quarantine(input_file, stage, error, data_path)
+            print(f"{stage}: {filename} failed, quarantined to {destination}")
+            append_entry(journal_path, {'stage': stage, 'file': filename, 'status': 'failed', 'time': time.time(),
+                                        'traceback': error, **signature})
+            summary['failed'] += 1
+            continue
+
+        status = 'done' if df is not None else 'skipped'
+        append_entry(journal_path, {'stage': stage, 'file': filename, 'status': status, 'time': time.time(),
+                                    **signature})
+        summary[status] += 1
+
+    print(f"{stage}: {summary['done']} done, {summary['skipped']} skipped, {summary['failed']} failed, "
+          f"{summary['resumed']} already completed" +
+          (f", {summary['failed_previously']} failed previously (use --retry-failed)"
+           if summary['failed_previously'] else ""))
+    return summary
+
+
+def check_stale_outputs(data_path: str = "../data/", filenames: tuple = ('0.csv', '1.csv')) -> list:
+    """
+    Runs stages 1 to 4 on a scratch copy of two parsed files, then corrupts the first, truncates the second
+    and runs stages 1 to 3 again. Neither file may keep an output in any stage.
+    :param data_path: data directory to copy the parsed files (and index.tsv) from
+    :param filenames: the two parsed files to use
+    :return: the stale outputs left behind (empty if none)
+    """
+    import cli
+
+    scratch = tempfile.mkdtemp()
+    try:
+        scratch_data_path = os.path.join(scratch, "data", "")
+        os.makedirs(scratch_data_path + "parsed")
+        os.makedirs(scratch_data_path + "indexed")
+        shutil.copyfile(os.path.abspath(data_path + "indexed/index.tsv"), scratch_data_path + "indexed/index.tsv")
+        for filename in filenames:
+            shutil.copyfile(os.path.abspath(data_path + "parsed/" + filename), scratch_data_path + "parsed/" + filename)
+
+        selection = ['--files', *[filename[:-len('.csv')] for filename in filenames]]
+        cli.main(['--data-root', scratch_data_path, 'tokens', *selection])
+        cli.main(['--data-root', scratch_data_path, 'stage4', *selection])
+
+        corrupted, truncated = filenames
+        with open(scratch_data_path + "parsed/" + corrupted, 'w') as f:
+            f.write('start,end\n"unterminated\n')
+        with open(scratch_data_path + "parsed/" + truncated) as f:
+            header = f.readline()
+        with open(scratch_data_path + "parsed/" + truncated, 'w') as f:
+            f.write(header)
+        cli.main(['--data-root', scratch_data_path, 'tokens', *selection])
+
+        return [f"stage_{n}_processed/{filename}" for n in range(1, LAST_STAGE + 1) for filename in filenames
+                if os.path.exists(scratch_data_path + f"stage_{n}_processed/" + filename)]
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == '__main__':
+    from cli import DEFAULT_DATA_PATH
+    stale = check_stale_outputs(DEFAULT_DATA_PATH)
+    print(f"stale outputs after upstream failures: {stale if stale else 'none'}")
+    raise SystemExit(1 if stale else 0)
@@ -0,0 +1,200 @@
+import gzip
+import io
+import json
+import os
+import queue
+import random
+import re
+import tarfile
+import threading
+
+import pandas as pd
+
+from processing_utils import read_index
+from run_journal import write_file_atomic
+
+MANIFEST_NAME = "manifest.json"
+FORMATS = ('tar', 'jsonl.gz')
+SHARD_PATTERN = re.compile(r'shard-\d{5}\.(?:tar|jsonl\.gz)')
+
+# token columns exported (when present), in this order
+TOKEN_COLUMNS = ['start', 'end', 'line', 'token', 'unformatted']
+
+
+def song_record(df: pd.DataFrame, idx: int, metadata: dict) -> dict:
+    """
+    Converts the tokens of one song to a JSON-serializable record.
+    Tokens are stored column-wise ({column -> list of values}) to keep records compact.
+    :param df: tokens of the song
+    :param idx: index of the song (see index.tsv)
+    :param metadata: index.tsv entry of the song (may be empty)
+    :return: record
+    """
+    columns = [c for c in TOKEN_COLUMNS if c in df.columns]
+    # missing values (e.g. empty tokens) become null, NaN is not valid JSON
+    tokens = {c: df[c].astype(object).where(df[c].notna(), None).tolist() for c in columns}
+    return {'index': idx, **metadata, 'rows': len(df), 'tokens': tokens}
+
+
+def _encode_shard(records: list, shard_format: str) -> bytes:
+    buffer = io.BytesIO()
+    if shard_format == 'tar':
+        with tarfile.open(fileobj=buffer, mode='w') as tar:
+            for record in records:
+                payload = json.dumps(record, ensure_ascii=False, allow_nan=False).encode('utf-8')
+                info = tarfile.TarInfo(name=f"{record['index']}.json")
+                info.size = len(payload)
+                tar.addfile(info, io.BytesIO(payload))
+    else:
+        with gzip.GzipFile(fileobj=buffer, mode='wb') as gz:
+            for record in records:
+                gz.write(json.dumps(record, ensure_ascii=False, allow_nan=False).encode('utf-8') + b"\n")
+    return buffer.getvalue()
+
+
+def _decode_shard(payload: bytes, shard_format: str) -> list:
+    if shard_format == 'tar':
+        with tarfile.open(fileobj=io.BytesIO(payload), mode='r') as tar:
+            return [json.loads(tar.extractfile(member).read()) for member in tar.getmembers() if member.isfile()]
+    with gzip.GzipFile(fileobj=io.BytesIO(payload), mode='rb') as gz:
+        return [json.loads(line) for line in gz if line.strip()]
+
+
+def _write_shard(output_path: str, shard_no: int, records: list, shard_format: str) -> dict:
+    name = f"shard-{shard_no:05d}.{shard_format}"
+    payload = _encode_shard(records, shard_format)
+    write_file_atomic(payload, output_path + name)
+    return {'name': name, 'bytes': len(payload), 'songs': len(records), 'rows': sum(r['rows'] for r in records)}
+
+
+def export_shards(custom_input_directory=None, custom_output_directory=None, shard_format: str = 'tar',
+                  rows_per_shard: int = 20000, data_path: str = "../data/", filenames: list = None) -> dict:
+    """
+    Packs the per-song token CSVs into shards of (roughly) rows_per_shard token rows each,
+    and writes a manifest listing every shard with its size and row count.
+    A song is never split across shards.
+    Shards and manifest are written atomically, the manifest last, and the shards of an earlier export are removed.
+    :param custom_input_directory: by default, will look at data/stage_3_processed/.
+    :param custom_output_directory: by default, will output to data/shards/.
+    :param shard_format: 'tar' (one JSON member per song) or 'jsonl.gz' (one JSON line per song)
+    :param rows_per_shard: a shard is closed once it holds at least this many token rows
+    :param data_path: data directory
+    :param filenames: files to export (by default, every CSV in the input directory)
+    :return: the manifest
+    """
+    if shard_format not in FORMATS:
+        raise ValueError(f"Unknown shard format {shard_format}, expected one of {FORMATS}")
+
+    input_path = custom_input_directory if custom_input_directory else data_path + "stage_3_processed/"
+    output_path = custom_output_directory if custom_output_directory else data_path + "shards/"
+    if not os.path.exists(os.path.abspath(output_path)):
+        os.makedirs(os.path.abspath(output_path))
+
+    # without a manifest, a reader cannot pick up a half-written export
+    for name in os.listdir(os.path.abspath(output_path)):
+        if name == MANIFEST_NAME or SHARD_PATTERN.fullmatch(name):
+            os.remove(os.path.abspath(output_path + name))
+
+    index = read_index(data_path + "indexed/index.tsv")
+
+    # sort songs by index, so that shards are reproducible
+    if filenames is None:
+        filenames = [f for f in os.listdir(os.path.abspath(input_path)) if f.endswith('.csv')]
+    filenames = sorted(filenames,
+                       key=lambda f: (not f[:-4].isdigit(), int(f[:-4]) if f[:-4].isdigit() else f))
+
+    shards = []
+    records = []
+    rows = 0
+    for filename in filenames:
+        with open(os.path.abspath(input_path + filename)) as f:
+            df = pd.read_csv(f, keep_default_na=False, na_values=[""])
+        idx = int(filename[:-4]) if filename[:-4].isdigit() else filename[:-4]
+        records.append(song_record(df, idx, index.get(idx, {})))
+        rows += len(df)
+
+        if rows >= rows_per_shard:
+            shards.append(_write_shard(output_path, len(shards), records, shard_format))
+            records = []
+            rows = 0
+    if records:
+        shards.append(_write_shard(output_path, len(shards), records, shard_format))
+
+    manifest = {
+        'format': shard_format,
+        'columns': TOKEN_COLUMNS,
+        'songs': sum(s['songs'] for s in shards),
+        'rows': sum(s['rows'] for s in shards),
+        'shards': shards,
+    }
+    write_file_atomic(json.dumps(manifest, indent=2).encode('utf-8'), output_path + MANIFEST_NAME)
+
+    return manifest
+
+
+def iterate_shards(shard_directory: str, shuffle: bool = True, seed: int = None, prefetch: int = 2,
+                   shard_indices: list = None):
+    """
+    Iterates over the song records of an exported shard directory.
+    Shards are read and decoded by a background thread, up to prefetch shards ahead of the consumer.
+    :param shard_directory: directory containing the manifest and the shards
+    :param shuffle: shuffle the shard order, and the songs within each shard
+    :param seed: random seed for the shuffling
+    :param prefetch: number of decoded shards kept ready in memory
+    :param shard_indices: positions (in the manifest) of the shards to read, e.g. to split shards between workers
+    :return: generator of song records
+    """
+    shard_directory = os.path.join(shard_directory, "")
+    with open(os.path.abspath(shard_directory + MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+
+    shards = manifest['shards']
+    if shard_indices is not None:
+        shards = [shards[i] for i in shard_indices]
+    rng = random.Random(seed)
+    if shuffle:
+        shards = rng.sample(shards, len(shards))
+
+    loaded = queue.Queue(maxsize=max(prefetch, 1))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                loaded.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def load():
+        try:
+            for shard in shards:
+                if stop.is_set():
+                    return
+                with open(os.path.abspath(shard_directory + shard['name']), 'rb') as shard_file:
+                    put(_decode_shard(shard_file.read(), manifest['format']))
+            put(done)
+        except Exception as e:
+            put(e)
+
+    loader = threading.Thread(target=load, daemon=True)
+    loader.start()
+    try:
+        while True:
+            records = loaded.get()
+            if records is done:
+                return
+            if isinstance(records, Exception):
+                raise records
+            if shuffle:
+                rng.shuffle(records)
+            yield from records
+    finally:
+        stop.set()
+        loader.join()
+
+
+if __name__ == '__main__':
+    from cli import DEFAULT_DATA_PATH
+    export_shards(custom_input_directory=None, custom_output_directory=None, data_path=DEFAULT_DATA_PATH)
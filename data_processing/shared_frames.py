@@ -0,0 +1,289 @@
+import multiprocessing
+import os
+import pickle
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+
+from processing_utils import convert_segments_to_tuples, decode_segments, encode_segments
+
+# alignment (in bytes) of every array packed into a shared block
+_ALIGNMENT = 64
+
+
+def _encode_columns(df: pd.DataFrame) -> tuple[list, dict]:
+    """
+    Splits df into numpy arrays (to be placed in shared memory) and small picklable metadata.
+    :return: (list of (array name, array), column metadata)
+    """
+    arrays = []
+    columns = []
+    for column in df.columns:
+        values = df[column]
+        if column == 'segments':
+            encoded = encode_segments(values)
+            for part in ('offsets', 'colors', 'chars'):
+                arrays.append((f'{column}.{part}', encoded[part]))
+            columns.append({'name': column, 'kind': 'segments', 'dictionary': encoded['dictionary']})
+        elif values.dtype.kind in 'biuf':
+            arrays.append((column, np.ascontiguousarray(values.to_numpy())))
+            columns.append({'name': column, 'kind': 'numeric'})
+        else:
+            # strings (and mixed object columns such as ref_end) are dictionary encoded,
+            # only the (sorted) dictionary itself is copied
+            codes, uniques = pd.factorize(values, sort=True, use_na_sentinel=True)
+            arrays.append((column, codes.astype(np.int32)))
+            columns.append({'name': column, 'kind': 'dictionary', 'dictionary': list(uniques)})
+    return arrays, {'columns': columns, 'index': df.index.tolist() if not _is_default_index(df) else None}
+
+
+def _is_default_index(df: pd.DataFrame) -> bool:
+    return isinstance(df.index, pd.RangeIndex) and df.index.start == 0 and df.index.step == 1
+
+
+def share_frame(df: pd.DataFrame) -> dict:
+    """
+    Copies df once into a single shared memory block and returns a small, picklable handle to it.
+    Numeric columns and encoded 'segments' arrays are stored as raw buffers,
+    string columns are stored as int32 codes plus a (copied) dictionary.
+
+    The caller owns the block and must call release_frame(handle) once every consumer is done.
+    :param df: DataFrame to hand off
+    :return: handle that can be sent to another process and passed to attach_frame
+    """
+    arrays, meta = _encode_columns(df)
+
+    layout = []
+    offset = 0
+    for name, array in arrays:
+        offset = -(-offset // _ALIGNMENT) * _ALIGNMENT
+        layout.append({'name': name, 'dtype': array.dtype.str, 'offset': offset, 'length': len(array)})
+        offset += array.nbytes
+
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for (_, array), entry in zip(arrays, layout):
+        view = np.ndarray(entry['length'], dtype=array.dtype, buffer=block.buf, offset=entry['offset'])
+        view[:] = array
+    block.close()
+
+    return {'block': block.name, 'rows': len(df), 'layout': layout, **meta}
+
+
+def _attach_block(name: str) -> shared_memory.SharedMemory:
+    """
+    Attaches to an existing block without registering it with this process' resource tracker,
+    otherwise the consumer would unlink (or warn about) a block it does not own.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # python < 3.13
+        block = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(block._name, 'shared_memory')
+        return block
+
+
+def _attach_views(handle: dict, block: shared_memory.SharedMemory) -> dict:
+    views = {}
+    for entry in handle['layout']:
+        view = np.ndarray(entry['length'], dtype=np.dtype(entry['dtype']), buffer=block.buf, offset=entry['offset'])
+        view.flags.writeable = False
+        views[entry['name']] = view
+    return views
+
+
+def attach_frame(handle: dict, materialize_segments: bool = True) -> tuple[pd.DataFrame, shared_memory.SharedMemory]:
+    """
+    Rebuilds the DataFrame described by handle on top of the shared block.
+    Numeric columns are views into the block, string columns are looked up from the shared codes.
+
+    The returned block must stay open for as long as the DataFrame (or anything derived from it) is used,
+    and be closed with block.close() afterwards.
+    :param handle: handle returned by share_frame
+    :param materialize_segments: if False, the 'segments' column is left out,
+                                 its encoded arrays can be read with attached_segments instead
+    :return: (df, block)
+    """
+    block = _attach_block(handle['block'])
+    views = _attach_views(handle, block)
+
+    data = {}
+    for column in handle['columns']:
+        name = column['name']
+        if column['kind'] == 'numeric':
+            data[name] = views[name]
+        elif column['kind'] == 'dictionary':
+            # plain object columns (not categoricals), so that sorting and string operations
+            # behave exactly as on the producer's frame
+            dictionary = np.array(column['dictionary'] + [np.nan], dtype=object)
+            data[name] = dictionary[views[name]]
+        elif materialize_segments:
+            encoded = {part: views[f'{name}.{part}'] for part in ('offsets', 'colors', 'chars')}
+            data[name] = decode_segments(**encoded, dictionary=column['dictionary'])
+
+    index = handle['index'] if handle['index'] is not None else pd.RangeIndex(handle['rows'])
+    df = pd.DataFrame(data, index=index, copy=False)
+
+    return df, block
+
+
+def attached_segments(handle: dict, block: shared_memory.SharedMemory, name: str = 'segments') -> dict or None:
+    """
+    The encoded segments column of an attached frame, as read-only views into the block.
+    Stage 3 only decodes the few rows it needs (see stage_3_processing.process_frame).
+    :param handle: handle returned by share_frame
+    :param block: block returned by attach_frame
+    :param name: name of the segments column
+    :return: dict with 'offsets', 'colors', 'chars' and 'dictionary' (see encode_segments), or None if there is none
+    """
+    for column in handle['columns']:
+        if column['name'] == name and column['kind'] == 'segments':
+            views = _attach_views(handle, block)
+            return {**{part: views[f'{name}.{part}'] for part in ('offsets', 'colors', 'chars')},
+                    'dictionary': column['dictionary']}
+    return None
+
+
+def release_frame(handle: dict) -> None:
+    """
+    Frees the shared block behind handle. Must be called exactly once, by the producer.
+    :param handle: handle returned by share_frame
+    """
+    block = shared_memory.SharedMemory(name=handle['block'])
+    block.close()
+    block.unlink()
+
+
+def _consume(connection) -> None:
+    """
+    Consumer side of benchmark_handoff, run in its own process.
+    Receives stage 2 outputs (pickled, or as shared memory handles), optionally runs stage 3 on them,
+    and acknowledges each one.
+    """
+    import stage_3_processing
+
+    while True:
+        mode, run_stage_3 = connection.recv()
+        if mode is None:
+            return
+        if mode == 'pickle':
+            df = pickle.loads(connection.recv_bytes())
+            if run_stage_3:
+                stage_3_processing.process_frame(df)
+        else:
+            handle = connection.recv()
+            df, block = attach_frame(handle, materialize_segments=(mode == 'shared'))
+            if run_stage_3:
+                stage_3_processing.process_frame(df, encoded_segments=attached_segments(handle, block))
+            del df
+            block.close()
+        connection.send(True)
+
+
+def benchmark_handoff(frames: list, repeats: int = 3) -> dict:
+    """
+    Times producer -> consumer hand-offs of frames to a separate process, through pickle and through shared memory.
+    Each time runs from the producer encoding a frame until the consumer acknowledges it,
+    either right after decoding it or after running stage 3 on it.
+    Modes: 'pickle', 'shared' (segments decoded on attach) and 'shared_lazy' (segments left encoded).
+    :param frames: DataFrames to hand off (stage 2 outputs, with a 'segments' column)
+    :param repeats: number of hand-offs per frame and mode (the best one is counted)
+    :return: dict with 'seconds' ({(mode, with stage 3) -> total over frames}) and 'bytes' ({mode -> total sent})
+    """
+    producer, consumer = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_consume, args=(consumer,), daemon=True)
+    process.start()
+
+    totals = {}
+    sent = {'pickle': 0, 'shared': 0, 'shared_lazy': 0}
+    try:
+        for df in frames:
+            for mode in ('pickle', 'shared', 'shared_lazy'):
+                for run_stage_3 in (False, True):
+                    times = []
+                    for _ in range(repeats):
+                        t0 = time.perf_counter()
+                        if mode == 'pickle':
+                            payload = pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+                            producer.send((mode, run_stage_3))
+                            producer.send_bytes(payload)
+                            producer.recv()
+                            size = len(payload)
+                        else:
+                            handle = share_frame(df)
+                            producer.send((mode, run_stage_3))
+                            producer.send(handle)
+                            producer.recv()
+                            size = len(pickle.dumps(handle, protocol=pickle.HIGHEST_PROTOCOL))
+                            release_frame(handle)
+                        times.append(time.perf_counter() - t0)
+                    totals[(mode, run_stage_3)] = totals.get((mode, run_stage_3), 0) + min(times)
+                sent[mode] += size
+    finally:
+        producer.send((None, False))
+        process.join()
+
+    return {'seconds': totals, 'bytes': sent}
+
+
+def check_round_trip(df: pd.DataFrame, process_frame, materialize_segments: bool = True) -> bool:
+    """
+    Checks that handing df off through shared memory does not change the output of the next stage.
+    :param df: output of a stage
+    :param process_frame: the next stage's process_frame function
+    :param materialize_segments: if False, process_frame gets the segments encoded (see attached_segments)
+    :return: True if the next stage gives the same output on df and on its attached copy
+    """
+    handle = share_frame(df)
+    try:
+        attached, block = attach_frame(handle, materialize_segments)
+        try:
+            expected = process_frame(df.copy())
+            if materialize_segments:
+                actual = process_frame(attached)
+            else:
+                actual = process_frame(attached, encoded_segments=attached_segments(handle, block))
+            return expected.equals(actual.astype(expected.dtypes.to_dict()))
+        finally:
+            del attached
+            block.close()
+    finally:
+        release_frame(handle)
+
+
+def main(data_path="../data/"):
+    import stage_2_processing
+    import stage_3_processing
+
+    # stage 1 outputs are not sorted, stage 2 outputs carry the 'segments' column
+    checks = ((2, "stage_1_processed/", stage_2_processing.process_frame, True),
+              (3, "stage_2_processed/", stage_3_processing.process_frame, True),
+              (3, "stage_2_processed/", stage_3_processing.process_frame, False))
+    mismatches = []
+    for stage, input_directory, process_frame, materialize_segments in checks:
+        for filename in sorted(os.listdir(os.path.abspath(data_path + input_directory))):
+            with open(os.path.abspath(data_path + input_directory + filename)) as f:
+                df = pd.read_csv(f)
+            if 'segments' in df.columns:
+                df = convert_segments_to_tuples(df)
+            if not check_round_trip(df, process_frame, materialize_segments):
+                mismatches.append(f"stage {stage}: {filename}")
+
+    frames = []
+    input_path = data_path + "stage_2_processed/"
+    for filename in sorted(os.listdir(os.path.abspath(input_path))):
+        with open(os.path.abspath(input_path + filename)) as f:
+            frames.append(convert_segments_to_tuples(pd.read_csv(f)))
+    result = benchmark_handoff(frames)
+
+    print(f"{len(frames)} stage 2 outputs handed off to a separate process:")
+    for mode in ('pickle', 'shared', 'shared_lazy'):
+        print(f"  {mode:<12} hand-off {result['seconds'][(mode, False)]:.3f}s, "
+              f"hand-off + stage 3 {result['seconds'][(mode, True)]:.3f}s ({result['bytes'][mode]} bytes sent)")
+    print(f"stage output changed by the hand-off: {mismatches if mismatches else 'none'}")
+
+
+if __name__ == '__main__':
+    from cli import DEFAULT_DATA_PATH
+    main(DEFAULT_DATA_PATH)
@@ -1,8 +1,11 @@
 import os
 from processing_utils import *
+from run_journal import later_stages, run_stage
+from text_normalization import filter_lines, normalize_text, profile_for
 
 
-def process_file(f) -> pd.DataFrame or None:
+def process_file(f, language: str = None) -> pd.DataFrame or None:
+    profile = profile_for(language)
 
     df = pd.read_csv(f)
     # if the df has less than 3 rows, then skip it
@@ -11,17 +14,16 @@ def process_file(f) -> pd.DataFrame or None:
         return None
 
     df = df.drop_duplicates()
-    # df = filter_rows(df)  # !!! NOTE that this is only for EN subtitles
+    df = filter_lines(df, profile)
 
     # if there are any nulls, print
     if df.isnull().values.any():
-        print(f + " has null values")
+        print(f"{os.path.basename(f.name)} has null values")
         df = df.dropna(how='any', axis=0)
 
     df = convert_time(df)
 
-    df['text'] = df['text'].apply(lambda x: x.replace("'", "\\'"))
-    df['text'] = df['text'].str.lower()
+    df['text'] = normalize_text(df['text'], profile)
 
     df['unformatted'] = df['text'].apply(unformatted)
     # drop columns where 'unformatted' is empty
@@ -30,20 +32,16 @@ def process_file(f) -> pd.DataFrame or None:
     return df
 
 
-def main():
+def main(data_path="../data/", filenames=None, **run_options):
     stage_no = 1
-    input_path = f"../data/parsed/"
-    output_path = f"../data/stage_{stage_no}_processed/"
-
-    for filename in os.listdir(os.path.abspath(input_path)):
-        with open(os.path.abspath(input_path + filename)) as f:
-
-            df = process_file(f)
-
-            if df is None:
-                continue
-
-            df.to_csv(os.path.abspath(output_path + filename), index=False)
+    input_path = data_path + "parsed/"
+    output_path = data_path + f"stage_{stage_no}_processed/"
+    index = read_index(data_path + "indexed/index.tsv")
+
+    run_stage(f"stage_{stage_no}", process_file, input_path, output_path,
+              data_path=data_path, filenames=filenames, **run_options,
+              downstream=later_stages(stage_no, data_path),
+              process_kwargs=lambda filename: {'language': file_language(filename, index)})
 
 
 if __name__ == '__main__':
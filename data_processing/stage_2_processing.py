@@ -1,8 +1,9 @@
 import os
 from processing_utils import *
+from run_journal import later_stages, run_stage
 
 
-def process_file(f) -> pd.DataFrame or None:
+def process_file(f, adaptive: bool = False) -> pd.DataFrame or None:
 
     df = pd.read_csv(f)
     # if the df has less than 3 rows, then skip it
@@ -10,9 +11,30 @@ def process_file(f) -> pd.DataFrame or None:
         print(f"Skipping {f.name.split('/')[-1]} because it has less than 3 rows.")
         return None
 
+    return process_frame(df, adaptive)
+
+
+def process_frame(df: pd.DataFrame, adaptive: bool = False) -> pd.DataFrame:
+    """
+    Stage 2 on an in-memory stage 1 output.
+    :param df: stage 1 output
+    :param adaptive: see generate_tokens_adaptive. Off by default: nearly every cue group of the corpus is
+                     progressive, so skipping the few others does not pay for classifying them.
+    :return: processed df
+    """
     # drop duplicate rows
     df = df.drop_duplicates(subset=['start', 'end', 'unformatted', 'line'], keep='first')
 
+    if adaptive:
+        # cue groups only depend on the timing and the text,
+        # so they are classified first and only the cues of progressive groups are expanded one by one
+        df = df.sort_values(by=['unformatted', 'line', 'start'], ascending=[True, False, False]).reset_index(drop=True)
+        df = compute_ref_start_end(df)
+        paths = classify_cue_groups(df, column='text')
+        df.insert(df.columns.get_loc('unformatted') + 1, 'segments', create_character_segments_adaptive(df, paths))
+        df = df.drop(columns=['position', 'text'])
+        return generate_tokens_adaptive(df, paths)
+
     df = create_segments(df)
     df = clean_segments(df)
     df = df.drop(columns=['position', 'text'])  # !!! DEBUGGING PURPOSES ONLY
@@ -20,25 +42,35 @@ def process_file(f) -> pd.DataFrame or None:
 
     df = df.sort_values(by=['unformatted', 'line', 'start'], ascending=[True, False, False]).reset_index(drop=True)
     df = compute_ref_start_end(df)
+    # the cue groups are only classified for the report
+    df.attrs['cue_paths'] = cue_path_counts(classify_cue_groups(df))
     df = generate_tokens(df)
 
     return df
 
 
-def main():
+def main(data_path="../data/", filenames=None, adaptive: bool = False, **run_options):
     stage_no = 2
-    input_path = f"../data/stage_{stage_no - 1}_processed/"
-    output_path = f"../data/stage_{stage_no}_processed/"
+    input_path = data_path + f"stage_{stage_no - 1}_processed/"
+    output_path = data_path + f"stage_{stage_no}_processed/"
 
-    for filename in os.listdir(os.path.abspath(input_path)):
-        with open(os.path.abspath(input_path + filename)) as f:
+    cue_paths = {}
 
-            df = process_file(f)
+    def count_cue_paths(filename, df):
+        for path, rows in df.attrs.get('cue_paths', {}).items():
+            cue_paths[path] = cue_paths.get(path, 0) + rows
 
-            if df is None:
-                continue
+    run_stage(f"stage_{stage_no}", process_file, input_path, output_path,
+              data_path=data_path, filenames=filenames, **run_options,
+              downstream=later_stages(stage_no, data_path), on_result=count_cue_paths,
+              process_kwargs=lambda filename: {'adaptive': adaptive})
 
-            df.to_csv(os.path.abspath(output_path + filename), index=False)
+    # files completed by a previous run are not counted
+    total = sum(cue_paths.values())
+    if total:
+        print(f"stage_{stage_no} cue paths ({'adaptive' if adaptive else 'reference'} engine):")
+    for path, rows in cue_paths.items():
+        print(f"  {path}: {rows} rows ({rows / total:.1%})" if total else f"  {path}: {rows} rows")
 
 
 if __name__ == '__main__':
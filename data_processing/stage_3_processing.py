@@ -1,8 +1,9 @@
 import os
 from processing_utils import *
+from run_journal import later_stages, run_stage
 
 
-def process_file(f) -> pd.DataFrame or None:
+def process_file(f, adaptive: bool = True) -> pd.DataFrame or None:
 
     df = pd.read_csv(f)
     # if the df has less than 3 rows, then skip it
@@ -11,28 +12,39 @@ def process_file(f) -> pd.DataFrame or None:
         return None
 
     df = convert_segments_to_tuples(df)
-    df = process_duplicates(df)
 
-    df = df.drop(columns=['ref_start', 'ref_end', 'dupe', 'segments'])
-    df = df.sort_values(by=['start', 'unformatted', 'line'], ascending=[True, True, False]).reset_index(drop=True)
+    return process_frame(df, adaptive)
 
-    return df
 
+def process_frame(df: pd.DataFrame, adaptive: bool = True, encoded_segments: dict = None) -> pd.DataFrame:
+    """
+    Stage 3 on an in-memory stage 2 output.
+    :param df: stage 2 output, with 'segments' as lists of tuples unless encoded_segments is given
+    :param adaptive: see process_duplicates_adaptive
+    :param encoded_segments: 'segments' as encoded by encode_segments (see shared_frames.attach_frame)
+    :return: processed df
+    """
+    if encoded_segments is not None and not adaptive:
+        # process_duplicates reads the segments of every row
+        df['segments'] = decode_segments(**encoded_segments)
+        encoded_segments = None
+    df = process_duplicates_adaptive(df, encoded_segments) if adaptive else process_duplicates(df)
 
-def main():
-    stage_no = 3
-    input_path = f"../data/stage_{stage_no - 1}_processed/"
-    output_path = f"../data/stage_{stage_no}_processed/"
+    df = df.drop(columns=[c for c in ['ref_start', 'ref_end', 'dupe', 'segments'] if c in df.columns])
+    df = df.sort_values(by=['start', 'unformatted', 'line'], ascending=[True, True, False]).reset_index(drop=True)
 
-    for filename in os.listdir(os.path.abspath(input_path)):
-        with open(os.path.abspath(input_path + filename)) as f:
+    return df
 
-            df = process_file(f)
 
-            if df is None:
-                continue
+def main(data_path="../data/", filenames=None, adaptive: bool = True, **run_options):
+    stage_no = 3
+    input_path = data_path + f"stage_{stage_no - 1}_processed/"
+    output_path = data_path + f"stage_{stage_no}_processed/"
 
-            df.to_csv(os.path.abspath(output_path + filename), index=False)
+    run_stage(f"stage_{stage_no}", process_file, input_path, output_path,
+              data_path=data_path, filenames=filenames, **run_options,
+              downstream=later_stages(stage_no, data_path),
+              process_kwargs=lambda filename: {'adaptive': adaptive})
 
 
 if __name__ == '__main__':
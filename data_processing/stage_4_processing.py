@@ -1,8 +1,10 @@
 import os
 from processing_utils import *
+from text_normalization import profile_for
+from run_journal import run_stage
 
 
-def process_file(f) -> pd.DataFrame or None:
+def process_file(f, language: str = None) -> pd.DataFrame or None:
     na_values = ["",
                  "#N/A",
                  "#N/A N/A",
@@ -20,33 +22,25 @@ def process_file(f) -> pd.DataFrame or None:
         print(f"Skipping {f.name.split('/')[-1]} because it has less than 3 rows.")
         return None
 
-    # df = df.drop(columns=['ref_start', 'ref_end', 'dupe', 'segments', 'unformatted'])
-    # df = df.sort_values(by=['start', 'line'], ascending=[True, False]).reset_index(drop=True)
-
-    # df = df[df['line']!=-1].copy()
+    df = df.sort_values(by=['start', 'line'], ascending=[True, False]).reset_index(drop=True)
 
+    # remove credits and punctuation
+    df = filter_tokens(df, profile_for(language))
     # pair lines
-    # df = pair_lines(df)
-    # remove punctuation
-
+    df = pair_lines(df)
 
     return df
 
 
-def main():
+def main(data_path="../data/", filenames=None, **run_options):
     stage_no = 4
-    input_path = f"../data/stage_{stage_no - 1}_processed/"
-    output_path = f"../data/stage_{stage_no}_processed/"
-
-    for filename in os.listdir(os.path.abspath(input_path)):
-        with open(os.path.abspath(input_path + filename)) as f:
-
-            df = process_file(f)
-
-            if df is None:
-                continue
+    input_path = data_path + f"stage_{stage_no - 1}_processed/"
+    output_path = data_path + f"stage_{stage_no}_processed/"
+    index = read_index(data_path + "indexed/index.tsv")
 
-            df.to_csv(os.path.abspath(output_path + filename), index=False)
+    run_stage(f"stage_{stage_no}", process_file, input_path, output_path,
+              data_path=data_path, filenames=filenames, **run_options,
+              process_kwargs=lambda filename: {'language': file_language(filename, index)})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,147 @@
+import html
+import re
+import sys
+import unicodedata
+from functools import lru_cache
+
+import pandas as pd
+
+# Per-language normalization/filtering options, selected with the 'Language' column of index.tsv.
+# Stage 1 (on the formatted 'text'):
+#   'escape_quotes': escape single quotes
+#   'lower': lowercase
+#   'width': width conversions to apply, among 'ascii' (full-width ASCII -> half-width)
+#            and 'kana' (half-width katakana and punctuation -> full-width)
+#   'lines': None, or the (min, max) range of 'line' values to keep
+# Stage 4 (on the tokens):
+#   'strip_punctuation': remove punctuation from the tokens (tokens left empty are dropped)
+#   'drop_credits': drop credit lines (lyrics/music/illustration/... by ...)
+LANGUAGE_PROFILES = {
+    'default': {
+        'escape_quotes': True,
+        'lower': True,
+        'width': (),
+        'lines': None,
+        'strip_punctuation': True,
+        'drop_credits': True,
+    },
+}
+# no width normalization for 'ja': the committed (and manually edited) outputs keep their characters as parsed
+# ('kana' would change 3 of them, 'ascii' 81)
+LANGUAGE_PROFILES['ja'] = {**LANGUAGE_PROFILES['default']}
+LANGUAGE_PROFILES['en'] = {**LANGUAGE_PROFILES['default'], 'width': ('ascii',), 'lines': (0, 49)}
+
+# credit roles, e.g. "作詞・作曲:yunomi", "mixingengineer:nnzn" or "【作画】てあせよは"
+# (the parsed lines have no spaces, so Latin roles cannot be matched as whole words)
+CREDIT_ROLES_KANJI = ['詞', '曲', '編', '歌', '唄', '絵', '画']
+CREDIT_ROLES_CJK = ['映像', 'イラスト', 'アニメーション', 'ミックス', 'マスタリング', 'デザイン', 'ディレクション',
+                    'レコーディング', 'ドラム', 'ベース', 'ギター', 'ヴァイオリン', 'ヴィオラ', 'チェロ', '鍵盤', 'ロゴ',
+                    'プロデュース', '制作', '協力', 'コンテ', 'モーション']
+CREDIT_ROLES_LATIN = ['lyric', 'music', 'compos', 'arrang', 'illust', 'movie', 'video', 'vocal', 'mix', 'master',
+                      'anim', 'guitar', 'bass', 'drum', 'piano', 'string', 'instrument', 'program', 'record',
+                      'engineer', 'direct', 'design', 'original', 'art', 'mv', 'thanks', 'chorus', 'violin', 'cello',
+                      'trumpet', 'trombone', 'sax', 'rap', 'logo', 'produc', 'manager', 'assistant', 'cinematograph',
+                      'special', 'sound', '3dcg']
+# near the start of a line, a role shortly followed by a colon:
+# - a Latin role must not continue a Latin word ('art' in "heart:", 'rap' in "wrap:")
+# - a single-kanji role must not be followed by hiragana ('歌' in "歌え：")
+# or a CJK role in brackets ("【作画】", but not "[chorus]", which marks a part of the lyrics)
+CREDIT_PATTERN = re.compile(
+    r'^[^:：]{{0,40}}?(?:(?<![a-z])(?:{latin})[^:：]{{0,20}}?[:：]|(?:{cjk})[^:：]{{0,20}}?[:：]'
+    r'|(?:{kanji})[^:：\u3040-\u309f]{{0,20}}?[:：]|[【\[][^】\]]{{0,20}}?(?:{cjk}|{kanji})[^】\]]{{0,20}}[】\]])'
+    .format(latin='|'.join(map(re.escape, CREDIT_ROLES_LATIN)), cjk='|'.join(map(re.escape, CREDIT_ROLES_CJK)),
+            kanji='|'.join(map(re.escape, CREDIT_ROLES_KANJI)))
+)
+
+# full-width ASCII (U+FF01 - U+FF5E) and ideographic space to their half-width equivalents,
+# except for ＜ and ＞, which would otherwise turn into formatting tags
+_FULLWIDTH_ASCII = str.maketrans({chr(c): chr(c - 0xFEE0) for c in range(0xFF01, 0xFF5F)
+                                  if chr(c) not in '＜＞'} | {'　': ' '})
+
+
+# half-width katakana and punctuation (U+FF61 - U+FF9F) to their full-width equivalents,
+# the voiced sound marks become combining marks, composed with the preceding kana by NFC ("ｶﾞ" -> "ガ")
+_HALFWIDTH_KANA = str.maketrans({chr(c): unicodedata.normalize('NFKC', chr(c)) for c in range(0xFF61, 0xFFA0)})
+_COMBINING_SOUND_MARKS = '[\u3099\u309a]'
+
+
+@lru_cache(maxsize=None)
+def punctuation_table() -> dict:
+    """
+    :return: translate table deleting every (Basic Multilingual Plane) unicode punctuation character
+    """
+    return str.maketrans('', '', ''.join(chr(c) for c in range(min(sys.maxunicode, 0xFFFF) + 1)
+                                         if unicodedata.category(chr(c)).startswith('P')))
+
+
+def profile_for(language: str or None) -> dict:
+    """
+    :param language: subtitle language (e.g. 'ja', 'en'), as found in index.tsv
+    :return: the language's options, or the default ones
+    """
+    return LANGUAGE_PROFILES.get(language, LANGUAGE_PROFILES['default'])
+
+
+def normalize_text(text: pd.Series, profile: dict) -> pd.Series:
+    """
+    Normalizes a whole column of (possibly formatted) text at once.
+    :param text: column of strings
+    :param profile: see LANGUAGE_PROFILES
+    :return: normalized column
+    """
+    if profile['escape_quotes']:
+        text = text.str.replace("'", "\\'", regex=False)
+    if profile['lower']:
+        text = text.str.lower()
+    if 'ascii' in profile['width']:
+        text = text.str.translate(_FULLWIDTH_ASCII)
+    if 'kana' in profile['width']:
+        text = text.str.translate(_HALFWIDTH_KANA)
+        # NFC only on the rows that need it, it is much slower than translate
+        voiced = text.str.contains(_COMBINING_SOUND_MARKS, regex=True, na=False)
+        if voiced.any():
+            text = text.copy()
+            text[voiced] = text[voiced].str.normalize('NFC')
+    return text
+
+
+def filter_lines(df: pd.DataFrame, profile: dict) -> pd.DataFrame:
+    """
+    Keeps the rows whose 'line' is in the profile's range.
+    :param df: with 'line' column
+    :param profile: see LANGUAGE_PROFILES
+    :return: filtered df
+    """
+    if profile['lines'] is None:
+        return df
+    low, high = profile['lines']
+    return df[df['line'].between(low, high)]
+
+
+def strip_punctuation(text: pd.Series) -> pd.Series:
+    """
+    :param text: column of strings
+    :return: column with every punctuation character removed
+    """
+    return text.str.translate(punctuation_table())
+
+
+def unescape_html(text: pd.Series) -> pd.Series:
+    """
+    :param text: column of strings
+    :return: column with HTML entities (such as the &amp; and &nbsp; left by the parser) decoded
+    """
+    escaped = text.str.contains('&', regex=False, na=False)
+    if not escaped.any():
+        return text
+    text = text.copy()
+    text[escaped] = text[escaped].map(html.unescape)
+    return text
+
+
+def is_credit(text: pd.Series) -> pd.Series:
+    """
+    :param text: column of (lowercased, unformatted) lines
+    :return: boolean column, True for credit lines
+    """
+    return text.str.match(CREDIT_PATTERN).fillna(False).astype(bool)